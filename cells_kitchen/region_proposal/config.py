@@ -17,6 +17,9 @@ dice loss function
 # general
 data_dir = r'C:\Users\erica and rick\Desktop\cells_kitchen'
 
+# prepare training data
+frames_h5 = False  # whether to copy each dataset's tifs to an h5 file that is read instead of the tifs
+
 # network
 test_datasets = ['N.00.00', 'N.01.01', 'N.02.00', 'N.03.00.t', 'N.04.00.t', 'YST']
 train_datasets = ['K53', 'J115', 'J123']
@@ -29,12 +32,21 @@ aug_rotation = True  # whether to apply 0, 90, 180, or 270 degree rotations rand
 aug_scaling = (.75, 1.25)  # min and max image scaling // set to (1, 1) for no scaling
 lr_init = .1
 normalize_subframes = False  # now this is built into the model when batch_normalization is True
+use_tf_data = True  # whether to load batches with tf.data rather than keras Sequence workers
+data_workers = None  # number of keras workers when use_tf_data is False // None uses all cores
+use_multiprocessing = False  # whether keras workers are processes rather than threads // train.py has no main guard, so only use where workers are forked (linux), not spawned (windows)
+max_queue_size = 16  # batches queued by keras workers when use_tf_data is False
+use_tfrecords = False  # whether to train on subframes written to tfrecords by prepare_training_data.py
+tfrecord_examples = 1000  # number of training subframes to write to tfrecords // ~0.5 MB each for 160x160 subframes with 5 layers
+tfrecord_cache = ''  # file for caching parsed tfrecords across epochs // '' caches in memory, which needs ~tfrecord_examples * 0.5 MB (~500 MB by default)
 subframe_size = (160, 160)  # each dimension must be divisible by four
 test_datasets = ['N.00.00', 'N.01.01', 'N.02.00', 'N.03.00.t', 'N.04.00.t', 'YST']
 train_datasets = ['K53', 'J115', 'J123']
 use_cpu = False  # whether to use CPU instead of GPU for training
+xla_jit = True  # whether to compile the model with XLA, which fuses the high pass filter with the following layers
 filters = 16  # seemed to work with as little as 16 // 8 was a little blurrier, which is encouraging...
 save_predictions_during_training = True  # set whether to save images of predictions at each epoch end during training
+quantize_model = False  # whether to convert the best model to int8 tflite and use it for the final predictions
 batch_size = 16
 epoch_size = 64  # number of images (NOT batches) in an epoch
 training_epochs = 5000  # epochs
@@ -1,12 +1,24 @@
-from keras.utils import Sequence
+from tensorflow.keras.utils import Sequence
+import tensorflow as tf
 import numpy as np
 import pandas as pd
 import config as cfg
 import os
+import glob
 import cv2
+from tqdm import tqdm
 import ipdb
 
 
+# layout of subframe examples written by write_tfrecords and read by load_tfrecords
+tfrecord_features = {
+    'X': tf.io.FixedLenFeature([], tf.string),
+    'y': tf.io.FixedLenFeature([], tf.string),
+    'shape_X': tf.io.FixedLenFeature([3], tf.int64),
+    'shape_y': tf.io.FixedLenFeature([3], tf.int64)
+}
+
+
 class DataGenerator(Sequence):
     '''
     each call returns stack of X and ys, whers stack contains batch_size images randomly selected for datasets
@@ -26,6 +38,7 @@ class DataGenerator(Sequence):
         self.epoch_size = epoch_size
         self.rotation = rotation
         self.scaling = scaling
+        self.pid = os.getpid()  # used to reseed numpy once in each keras worker process
 
         # load features and labels into DataFrame
         self.data = pd.DataFrame(index=datasets, columns=['X', 'y', 'corner_max'])
@@ -45,17 +58,14 @@ class DataGenerator(Sequence):
     def __getitem__(self, index):
 
         # gets data for batch
-        batch_inds = np.random.randint(0, len(self.datasets), size=self.batch_size)  # indices of datasets to be used in batch
+        if self.pid != os.getpid():  # worker processes start with the parent's random state, so reseed once per worker
+            np.random.seed()
+            self.pid = os.getpid()
         X = np.zeros(self.shape_X)
         y = np.zeros(self.shape_y)
 
-        for i, b in enumerate(batch_inds):
-            corner = (np.random.randint(self.data.loc[self.datasets[b], 'corner_max'][0]),
-                      np.random.randint(self.data.loc[self.datasets[b], 'corner_max'][1]))
-            x_inds = slice(corner[0], corner[0]+self.subframe_size[0])
-            y_inds = slice(corner[1], corner[1]+self.subframe_size[1])
-            X[i] = self.data.loc[self.datasets[b], 'X'][x_inds, y_inds]
-            y[i] = self.data.loc[self.datasets[b], 'y'][x_inds, y_inds]
+        for i, (b, corner) in zip(range(self.batch_size), self.get_subframe_inds()):
+            X[i], y[i] = self.load_subframe(b, corner)
 
         # rotate
         if self.rotation:
@@ -86,3 +96,135 @@ class DataGenerator(Sequence):
 
     def __len__(self):
         return self.epoch_size
+
+    def get_subframe_inds(self):
+        """yields (dataset index, subframe corner) for randomly selected subframes indefinitely"""
+
+        while True:
+            b = np.random.randint(0, len(self.datasets))
+            corner_max = self.data.loc[self.datasets[b], 'corner_max']
+            yield b, (np.random.randint(corner_max[0]), np.random.randint(corner_max[1]))
+
+    def load_subframe(self, b, corner):
+        """returns X and y for subframe with top left corner at corner in dataset b"""
+
+        x_inds = slice(corner[0], corner[0]+self.subframe_size[0])
+        y_inds = slice(corner[1], corner[1]+self.subframe_size[1])
+        X = self.data.loc[self.datasets[b], 'X'][x_inds, y_inds]
+        y = self.data.loc[self.datasets[b], 'y'][x_inds, y_inds]
+
+        return X.astype('float32'), y.astype('float32')
+
+    def get_dataset(self, private_threadpool=True):
+        """
+        returns infinite tf.data.Dataset of augmented batches // subframes are loaded in parallel on the cpu and
+        augmented with tf ops, so batches are prepared while the gpu trains on the previous batch // private_threadpool
+        gives the dataset its own pool of cpu_count threads, which should only be used for one dataset at a time
+        """
+
+        def load_subframe(b, corner):
+            X, y = tf.py_function(lambda b, corner: self.load_subframe(b.numpy(), corner.numpy()),
+                                  [b, corner], [tf.float32, tf.float32])
+            X.set_shape(self.shape_X[1:])
+            y.set_shape(self.shape_y[1:])
+            return X, y
+
+        dataset = tf.data.Dataset.from_generator(self.get_subframe_inds, output_types=(tf.int32, tf.int32),
+                                                 output_shapes=((), (2,)))
+        dataset = dataset.map(load_subframe, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        dataset = dataset.batch(self.batch_size)
+        dataset = dataset.map(lambda X, y: augment_batch(X, y, self.rotation, self.normalize_subframes, self.scaling),
+                              num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+        return dataset.with_options(get_dataset_options(private_threadpool)).prefetch(tf.data.experimental.AUTOTUNE)
+
+
+def write_tfrecords(generator, folder, examples=1000, examples_per_shard=1024):
+    """
+    writes randomly selected subframes from generator to tfrecord files in folder, so training can read a few large
+    files sequentially // each example stores X, y, and their shapes
+    """
+
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    for f in glob.glob(os.path.join(folder, '*.tfrecord')):
+        os.remove(f)
+
+    subframe_inds = generator.get_subframe_inds()
+    for shard in tqdm(range(int(np.ceil(examples / examples_per_shard)))):
+        with tf.io.TFRecordWriter(os.path.join(folder, 'shard%04i.tfrecord' % shard)) as writer:
+            for _ in range(min(examples_per_shard, examples - shard*examples_per_shard)):
+                X, y = generator.load_subframe(*next(subframe_inds))
+                features = {
+                    'X': tf.train.Feature(bytes_list=tf.train.BytesList(value=[X.tobytes()])),
+                    'y': tf.train.Feature(bytes_list=tf.train.BytesList(value=[y.tobytes()])),
+                    'shape_X': tf.train.Feature(int64_list=tf.train.Int64List(value=X.shape)),
+                    'shape_y': tf.train.Feature(int64_list=tf.train.Int64List(value=y.shape))
+                }
+                writer.write(tf.train.Example(features=tf.train.Features(feature=features)).SerializeToString())
+
+
+def load_tfrecords(folder, batch_size=8, rotation=True, normalize_subframes=False, scaling=(1, 1), cache_file=''):
+    """
+    returns infinite tf.data.Dataset of augmented batches of the subframes written to folder by write_tfrecords
+    // parsed subframes are cached before augmentation, in memory if cache_file is '' and in cache_file otherwise, so
+    files are only read and decoded during the first epoch
+    """
+
+    def parse_example(example):
+        example = tf.io.parse_single_example(example, tfrecord_features)
+        X = tf.reshape(tf.io.decode_raw(example['X'], tf.float32), example['shape_X'])
+        y = tf.reshape(tf.io.decode_raw(example['y'], tf.float32), example['shape_y'])
+        return X, y
+
+    dataset = tf.data.Dataset.list_files(os.path.join(folder, '*.tfrecord'))
+    dataset = dataset.interleave(tf.data.TFRecordDataset, cycle_length=tf.data.experimental.AUTOTUNE,
+                                 num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.map(parse_example, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.cache(cache_file)
+    dataset = dataset.shuffle(2048).repeat()
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(lambda X, y: augment_batch(X, y, rotation, normalize_subframes, scaling),
+                          num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    return dataset.with_options(get_dataset_options()).prefetch(tf.data.experimental.AUTOTUNE)
+
+
+def get_dataset_options(private_threadpool=True):
+    """
+    returns tf.data.Options with static optimizations used by all datasets // private_threadpool gives the dataset its
+    own pool of cpu_count threads, so it should be False for datasets consumed alongside the training dataset
+    """
+
+    options = tf.data.Options()
+    options.experimental_optimization.map_and_batch_fusion = True
+    options.experimental_optimization.parallel_batch = True
+    if private_threadpool:
+        options.threading.private_threadpool_size = os.cpu_count()
+
+    return options
+
+
+def augment_batch(X, y, rotation=True, normalize_subframes=False, scaling=(1, 1)):
+    """tf version of the augmentation in DataGenerator.__getitem__, applied to a batch of X and y tensors"""
+
+    # rotate
+    if rotation:
+        rotations = tf.random.uniform((), 0, 4, dtype=tf.int32)  # number of 90 degree rotations to perform
+        X = tf.image.rot90(X, rotations)
+        y = tf.image.rot90(y, rotations)
+
+    # normalize
+    if normalize_subframes:
+        mean, variance = tf.nn.moments(X, axes=[1, 2], keepdims=True)
+        X = (X - mean) / tf.sqrt(variance)
+
+    # rescale
+    if scaling != (1, 1):
+        scale = tf.random.uniform((), scaling[0], scaling[1])
+        shape_new = tf.cast(tf.cast(tf.shape(X)[1:3], tf.float32) * scale, tf.int32)
+        shape_new = 16 * (shape_new // 16)  # ensure dimensions are divisible by 16
+        X = tf.image.resize(X, shape_new)
+        y = tf.image.resize(y, shape_new)
+
+    return X, y
@@ -1,28 +1,32 @@
-from keras.models import Model
-from keras.layers import Input, Conv2D, Conv2DTranspose, MaxPooling2D, Add, UpSampling2D, SpatialDropout2D,\
+import tensorflow as tf
+from tensorflow.keras.models import Model
+from tensorflow.keras.layers import Input, Conv2D, Conv2DTranspose, MaxPooling2D, Add, UpSampling2D, SpatialDropout2D,\
     concatenate, BatchNormalization, DepthwiseConv2D, Subtract
-from keras.optimizers import Adam
+from tensorflow.keras.optimizers import Adam
 from scipy import signal
 import numpy as np
 import ipdb
-import keras.backend as K
+import tensorflow.keras.backend as K
 
 
 def unet(input_size, output_channels, filters=32, lr_init=.001, kernel_initializer='glorot_normal',
          batch_normalization=False, high_pass_sigma=15):
     # unet modified from: https://github.com/zhixuhao/unet/blob/master/model.py
 
-    # set up gaussian kernel for high pass filtering
-    filt_size = 61
-    gaus_1D = signal.gaussian(filt_size, high_pass_sigma, sym=True)
-    gaus2D = np.outer(gaus_1D, gaus_1D)
-    gaus2D = gaus2D / np.sum(gaus2D)
-    gaus2D = np.repeat(gaus2D[:,:,np.newaxis], input_size[-1], axis=-1)
-    lowpass_layer = DepthwiseConv2D((filt_size, filt_size), use_bias=False, padding='same')
-
     inputs = Input(input_size)
-    lowpass = lowpass_layer(inputs)  # low pass filter inputs
-    inputs_2 = Subtract()([inputs, lowpass]) if high_pass_sigma else inputs  # high pass by subtracting low passed img
+    inputs_2 = inputs
+
+    # high pass by subtracting inputs low passed by a fixed gaussian, so filtering runs on the gpu in the model graph
+    if high_pass_sigma:
+        filt_size = 61
+        gaus_1D = signal.windows.gaussian(filt_size, high_pass_sigma, sym=True)
+        gaus2D = np.outer(gaus_1D, gaus_1D)
+        gaus2D = gaus2D / np.sum(gaus2D)
+        gaus2D = np.repeat(gaus2D[:, :, np.newaxis, np.newaxis], input_size[-1], axis=2)
+        lowpass = DepthwiseConv2D((filt_size, filt_size), use_bias=False, padding='same', trainable=False,
+                                  weights=[gaus2D], name='lowpass')(inputs)
+        inputs_2 = Subtract()([inputs, lowpass])
+
     inputs_2 = BatchNormalization(input_shape=input_size)(inputs_2) if batch_normalization else inputs_2  # normalize inputs
 
     conv1 = Conv2D(filters, 3, activation='relu', padding='same', kernel_initializer=kernel_initializer)(inputs_2)
@@ -82,14 +86,43 @@ def unet(input_size, output_channels, filters=32, lr_init=.001, kernel_initializ
 
     conv10 = Conv2D(output_channels, 1, activation='sigmoid')(conv9)
 
-    # set up lowpass filter weights
-    lowpass_layer.set_weights([np.expand_dims(gaus2D, axis=-1)])
-    lowpass_layer.trainable = False  # the weights should not change during training
-
     # compile
-    model = Model(input=inputs, output=conv10, name="unet")
-    model.compile(optimizer=Adam(lr=lr_init), loss='binary_crossentropy', metrics=['accuracy'])
+    model = Model(inputs=inputs, outputs=conv10, name="unet")
+    model.compile(optimizer=Adam(learning_rate=lr_init), loss='binary_crossentropy', metrics=['accuracy'])
     model.summary()
 
     return model
 
+
+class QuantizedModel:
+    """
+    int8 tflite version of a keras model, for faster inference on the cpu // calibrates activation ranges on batches
+    from generator, saves the converted model to file, and makes predictions via predict, like the keras model
+    """
+
+    def __init__(self, model, generator, file, calibration_batches=4):
+
+        def representative_dataset():
+            for i in range(calibration_batches):
+                for X in generator[i][0]:
+                    yield [X[np.newaxis].astype('float32')]
+
+        converter = tf.lite.TFLiteConverter.from_keras_model(model)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        with open(file, 'wb') as f:
+            f.write(converter.convert())
+
+        self.interpreter = tf.lite.Interpreter(model_path=file)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+
+    def predict(self, X):
+
+        # resize input to batch, which can change size with scaling augmentation
+        self.interpreter.resize_tensor_input(self.input_index, X.shape)
+        self.interpreter.allocate_tensors()
+        self.interpreter.set_tensor(self.input_index, X.astype('float32'))
+        self.interpreter.invoke()
+
+        return self.interpreter.get_tensor(self.output_index)
@@ -1,8 +1,10 @@
 import glob
+import contextlib
 import config as cfg
 import numpy as np
 import os
 import utils
+import h5py
 from tqdm import tqdm
 import ipdb as ipdb
 
@@ -17,6 +19,17 @@ for d in cfg.datasets:
     total_frames = len(glob.glob(os.path.join(folder, '*.tif')))
     batch_inds = np.arange(0, total_frames, cfg.summary_frames)
 
+    # optionally copy frames to h5 file once, so later runs read contiguous chunks rather than individual tifs //
+    # the copy is remade if the number of tifs has changed
+    h5_file = folder + '.h5'
+    if cfg.frames_h5:
+        h5_frames = 0
+        if os.path.exists(h5_file):
+            with h5py.File(h5_file, 'r') as frames:
+                h5_frames = frames['imgs'].shape[0]
+        if h5_frames != total_frames:
+            utils.tif_folder_to_h5(folder, h5_file)
+
     # Get the size of the images and initialize the iamge stack
     img0 = utils.get_frames(folder, frame_numbers=[0])
     height, width = img0.shape
@@ -31,15 +44,19 @@ for d in cfg.datasets:
     X = {key: np.zeros((batches, height, width)) for key in summary_titles}
 
     # get summary images for each batch in video
-    for b in tqdm(range(batches)):
-        img_stack = utils.get_frames(folder, 
-            frame_numbers=np.arange(batch_inds[b], batch_inds[b]+cfg.summary_frames))
-
-        X['corr'][b] = utils.get_correlation_image(img_stack)
-        X['mean'][b] = np.mean(img_stack, 0)
-        X['median'][b] = np.median(img_stack, 0)
-        X['max'][b] = img_stack.max(0)
-        X['std'][b] = img_stack.std(0)
+    with (h5py.File(h5_file, 'r') if cfg.frames_h5 else contextlib.nullcontext()) as frames:
+        for b in tqdm(range(batches)):
+            if cfg.frames_h5:
+                img_stack = frames['imgs'][batch_inds[b]:batch_inds[b]+cfg.summary_frames]
+            else:
+                img_stack = utils.get_frames(folder,
+                    frame_numbers=np.arange(batch_inds[b], batch_inds[b]+cfg.summary_frames))
+
+            X['corr'][b] = utils.get_correlation_image(img_stack)
+            X['mean'][b] = np.mean(img_stack, 0)
+            X['median'][b] = np.median(img_stack, 0)
+            X['max'][b] = img_stack.max(0)
+            X['std'][b] = img_stack.std(0)
 
     # collapse across summary images and scale from 0-1
     X['corr'] = utils.scale_img(X['corr'].max(0))
@@ -64,6 +81,14 @@ for d in cfg.datasets:
         os.makedirs(training_data_folder)
     np.savez(os.path.join(training_data_folder, d), X=X, y=y, neuron_masks=neuron_masks)
 
+# write training subframes to tfrecords
+if cfg.use_tfrecords:
+    from data_generator import DataGenerator, write_tfrecords  # imported here so tensorflow is only needed for tfrecords
+    print('writing training subframes to tfrecords')
+    generator = DataGenerator(cfg.train_datasets, subframe_size=cfg.subframe_size)
+    write_tfrecords(generator, os.path.join(cfg.data_dir, 'training_data', 'tfrecords'),
+                    examples=cfg.tfrecord_examples)
+
 # write sample images to disk
 utils.write_sample_imgs(X_contrast=(5, 99))
 print('all done!')
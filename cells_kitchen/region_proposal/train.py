@@ -1,8 +1,7 @@
-from data_generators import DataGenerator
-from keras.models import load_model
+from data_generator import DataGenerator, load_tfrecords
 import tensorflow as tf
-import keras.backend as K
-from keras.callbacks import ModelCheckpoint, EarlyStopping, LambdaCallback
+from tensorflow.keras.models import load_model
+from tensorflow.keras.callbacks import ModelCheckpoint, EarlyStopping, LambdaCallback
 import losswise
 from losswise.libs import LosswiseKerasCallback
 import config as cfg
@@ -16,6 +15,9 @@ import utils
 if cfg.losswise_api_key:
     losswise.set_api_key(cfg.losswise_api_key)  # set up losswise.com visualization
 
+if cfg.use_cpu:
+    tf.config.set_visible_devices([], 'GPU')  # must happen before any tensorflow ops run
+
 # create model data generators
 train_generator = DataGenerator(cfg.train_datasets, batch_size=cfg.batch_size, subframe_size=cfg.subframe_size,
                                 normalize_subframes=cfg.normalize_subframes, epoch_size=cfg.epoch_size//cfg.batch_size,
@@ -25,12 +27,24 @@ test_generator = DataGenerator(cfg.test_datasets, batch_size=cfg.batch_size, sub
                                rotation=cfg.aug_rotation, scaling=cfg.aug_scaling)
 
 # create model
+if cfg.xla_jit:
+    tf.config.optimizer.set_jit(True)
 # model = models.unet(train_generator.shape_X[1:], train_generator.shape_y[-1], filters=cfg.filters)
 model = models.unet((None, None, train_generator.shape_X[-1]), train_generator.shape_y[-1], filters=cfg.filters,
                     kernel_initializer='glorot_normal', batch_normalization=cfg.batch_normalization,
                     high_pass_sigma=cfg.high_pass_sigma)
 
 
+if cfg.use_tfrecords:
+    train_ds = load_tfrecords(os.path.join(cfg.data_dir, 'training_data', 'tfrecords'), batch_size=cfg.batch_size,
+                              rotation=cfg.aug_rotation, normalize_subframes=cfg.normalize_subframes,
+                              scaling=cfg.aug_scaling, cache_file=cfg.tfrecord_cache)
+elif cfg.use_tf_data:
+    train_ds = train_generator.get_dataset()
+if cfg.use_tfrecords or cfg.use_tf_data:
+    test_ds = test_generator.get_dataset(private_threadpool=False)  # validation shares the default pool with training
+
+
 # get predictions for single batch
 def save_prediction_imgs(generator, model_in, folder):
     X, y = generator[0]
@@ -41,11 +55,6 @@ def save_prediction_imgs(generator, model_in, folder):
 
 
 # train, omg!
-if cfg.use_cpu:
-    config = tf.ConfigProto(device_count={'GPU': 0})
-    sess = tf.Session(config=config)
-    K.set_session(sess)
-
 model_folder = datetime.now().strftime('%y%m%d_%H.%M.%S')
 # model_folder = 'test'
 model_path = os.path.join(cfg.data_dir, 'models', model_folder)
@@ -57,16 +66,25 @@ if cfg.save_predictions_during_training:
 
 if cfg.losswise_api_key:
     callbacks.append(LosswiseKerasCallback(tag='giterdone', display_interval=1))
-history = model.fit_generator(generator=train_generator, validation_data=test_generator,
-                              epochs=cfg.training_epochs, callbacks=callbacks)
+if cfg.use_tfrecords or cfg.use_tf_data:
+    history = model.fit(train_ds, validation_data=test_ds, steps_per_epoch=len(train_generator),
+                        validation_steps=len(test_generator), epochs=cfg.training_epochs, callbacks=callbacks)
+else:
+    history = model.fit(train_generator, validation_data=test_generator, epochs=cfg.training_epochs,
+                        callbacks=callbacks, workers=cfg.data_workers or os.cpu_count(),
+                        use_multiprocessing=cfg.use_multiprocessing,
+                        max_queue_size=cfg.max_queue_size)
 
 with open(os.path.join(model_path, 'training_history'), 'wb') as training_file:
     pickle.dump(history.history, training_file)
 
-# load best model and delete others
-models_to_delete = glob(os.path.join(model_path, '*hdf5'))[:-1]
-[os.remove(mod) for mod in iter(models_to_delete)]
+# load best model and delete others // with save_best_only the most recently saved model is the best
+models_to_delete = sorted(glob(os.path.join(model_path, '*hdf5')), key=os.path.getmtime)[:-1]
+for mod in models_to_delete:
+    os.remove(mod)
 model = load_model(glob(os.path.join(model_path, '*.hdf5'))[0])
+if cfg.quantize_model:
+    model = models.QuantizedModel(model, test_generator, os.path.join(model_path, 'model_int8.tflite'))
 
 # generate final predictions
 save_prediction_imgs(test_generator, model, model_path)
@@ -1,19 +1,26 @@
 import glob
 import os
+from functools import lru_cache
 import numpy as np
 from tqdm import tqdm
 from scipy.ndimage import convolve
 from scipy.stats import zscore
+from joblib import Parallel, delayed
 import matplotlib.pyplot as plt
 import json
 import cv2
 import tifffile
+import h5py
 import ipdb
 from PIL import Image, ImageDraw, ImageFont
 import config as cfg
+try:
+    from numba import njit, prange
+except ImportError:  # get_correlation_image falls back to numpy when numba is not installed
+    njit = None
 
 
-def get_frames(folder, frame_numbers=None):
+def get_frames(folder, frame_numbers=None, mmap=False):
     """Gets stack of images from folder containing tiff files 
     
     folder : path to directory containing images ending in ".tif"
@@ -23,6 +30,9 @@ def get_frames(folder, frame_numbers=None):
         If a list of integers, returns the corresponding images.
         If an integer, returns that many evenly spaced images.
 
+    mmap : bool
+        If True and a single file is loaded, returns a read only memory map of the file rather than reading it
+
     Returns : array of size (n_images, width, height)
     """
     # Get list of files in the directory
@@ -39,22 +49,45 @@ def get_frames(folder, frame_numbers=None):
     
     elif hasattr(frame_numbers, '__len__'):
         # Keep the ones specified by the list
-        load_files = list(np.asarray(files)[frame_numbers])
+        load_files = [files[i] for i in frame_numbers]
     
     else:
         # Keep that many evenly spaced
         indices = np.floor(
             np.linspace(0, len(files) - 1, frame_numbers)
-            ).astype(np.int)
+            ).astype(int).tolist()
         
-        load_files = list(np.asarray(files)[indices])
+        load_files = [files[i] for i in indices]
 
-    # Load them
-    imgs = tifffile.imread(load_files)
+    # Load them, decoding multiple files in parallel
+    if len(load_files) == 1:
+        imgs = tifffile.memmap(load_files[0], mode='r') if mmap else tifffile.imread(load_files[0])
+    else:
+        imgs = tifffile.TiffSequence(load_files).asarray(ioworkers=min(16, len(load_files)))
 
     return imgs
 
 
+def tif_folder_to_h5(folder, file, frames_per_batch=1000):
+    """
+    writes all tif files in folder, in the order used by get_frames, to dataset 'imgs' of size (n_images, height,
+    width) in h5 file // chunked by frame so contiguous batches of frames can be read without opening each tif. the
+    file is written to a temporary path and only moved to file when complete, so an interrupted conversion is never read
+    """
+
+    total_frames = len(glob.glob(os.path.join(folder, '*.tif')))
+    img0 = get_frames(folder, frame_numbers=[0])
+
+    file_temp = file + '.tmp'
+    with h5py.File(file_temp, 'w') as f:
+        imgs = f.create_dataset('imgs', shape=(total_frames,) + img0.shape, dtype=img0.dtype,
+                                chunks=(1,) + img0.shape, compression='lzf')
+        for i in tqdm(range(0, total_frames, frames_per_batch)):
+            frame_numbers = list(range(i, min(i+frames_per_batch, total_frames)))
+            imgs[i:i+frames_per_batch] = get_frames(folder, frame_numbers=frame_numbers)
+    os.replace(file_temp, file)
+
+
 def preview_vid(folder, frames_to_show=100, fps=30, close_when_done=False):
     """
     opens window and plays movie from sequence of .tif files
@@ -82,40 +115,87 @@ def get_correlation_image(imgs):
     given stack of images, returns image representing temporal correlation between each pixel and surrounding eight pixels
     """
 
-    imgs = imgs.copy()  # make sure we're pointing to a new object
-
-    # define 8 neighbors filter
-    kernel = np.ones((3, 3), dtype='float32')
-    kernel[1, 1] = 0
-    mask = convolve(np.ones(imgs.shape[1:], dtype='float32'), kernel, mode='constant')
-
     # normalize image
-    # imgs = zscore(imgs, axis=0)
-    imgs -= np.mean(imgs, axis=0)
+    imgs_mean = np.mean(imgs, axis=0)
     imgs_std = np.std(imgs, axis=0)
     imgs_std[imgs_std == 0] = np.inf
-    imgs /= imgs_std
+
+    if njit is not None:
+        img_corr = np.zeros(imgs.shape[1:])
+        _correlation_image(imgs, imgs_mean, 1 / imgs_std, img_corr)
+        return img_corr
+
+    imgs = np.array(imgs, dtype='float32')  # float32 copy that is normalized in place
+
+    # imgs = zscore(imgs, axis=0)
+    np.subtract(imgs, imgs_mean, out=imgs)
+    np.divide(imgs, imgs_std, out=imgs)
+
+    # sum eight neighbors of each pixel with a 3x3 box filter minus the center pixel, one frame per thread
+    img_corr = np.empty_like(imgs)
+
+    def sum_neighbors(t):
+        img_corr[t] = cv2.boxFilter(imgs[t], -1, (3, 3), normalize=False, borderType=cv2.BORDER_CONSTANT) - imgs[t]
+
+    Parallel(n_jobs=-1, prefer='threads')(delayed(sum_neighbors)(t) for t in range(imgs.shape[0]))
 
     # compute correlation image
-    img_corr = convolve(imgs, kernel[np.newaxis, :], mode='constant') / mask
-    img_corr = imgs * img_corr
+    img_corr /= _neighbor_mask(imgs.shape[1:])
+    img_corr *= imgs
     img_corr = np.mean(img_corr, 0)
 
     return img_corr
 
 
-def scale_img(img):
-    """ scales numpy array between 0 and 1"""
+@lru_cache(maxsize=8)
+def _neighbor_mask(shape):
+    """returns number of neighbors each pixel has in image of size shape, used to normalize the correlation image"""
 
-    if np.ptp(img):
-        img = (img - np.min(img)) / np.ptp(img)
+    kernel = np.ones((3, 3), dtype='float32')
+    kernel[1, 1] = 0
+    return convolve(np.ones(shape, dtype='float32'), kernel, mode='constant')
+
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _correlation_image(imgs, imgs_mean, imgs_std_inv, img_corr):
+        """
+        numba version of get_correlation_image that normalizes, averages over the eight neighbors, and averages over
+        time in a single pass through imgs // parallelized across rows so each thread writes to its own part of img_corr
+        """
+
+        frames, height, width = imgs.shape
+        for r in prange(height):
+            for t in range(frames):
+                for c in range(width):
+                    neighbor_sum = 0.0
+                    neighbors = 0
+                    for rr in range(max(r-1, 0), min(r+2, height)):
+                        for cc in range(max(c-1, 0), min(c+2, width)):
+                            if rr != r or cc != c:
+                                neighbor_sum += (imgs[t, rr, cc] - imgs_mean[rr, cc]) * imgs_std_inv[rr, cc]
+                                neighbors += 1
+                    center = (imgs[t, r, c] - imgs_mean[r, c]) * imgs_std_inv[r, c]
+                    img_corr[r, c] += center * neighbor_sum / neighbors
+            for c in range(width):
+                img_corr[r, c] /= frames
+
+
+def scale_img(img, axis=None):
+    """ scales numpy array between 0 and 1, separately for each slice along dimensions other than axis if provided"""
+
+    img_min = np.min(img, axis=axis, keepdims=True)
+    img_ptp = np.ptp(img, axis=axis, keepdims=True)
+    img = np.divide(img - img_min, img_ptp, out=np.array(img, dtype='float64'), where=img_ptp != 0)
     return img
 
 
 def get_targets(folder, collapse_masks=False, centroid_radius=2, border_thickness=2):
     """
     for folder containing labeled data, returns masks for soma, border of cells, and centroid. returned as 3D bool
-    stacks, with one mask per cell, unless collapse_masks is True, in which case max is taken across all cells
+    stacks, with one mask per cell, unless collapse_masks is True, in which case max is taken across all cells //
+    borders approximate the old cv2.drawContours borders but differ by a few pixels per cell, and are not drawn along
+    the image edge for cells touching it, so training data prepared with the old borders should be regenerated
     """
 
     # get image dimensions
@@ -126,16 +206,40 @@ def get_targets(folder, collapse_masks=False, centroid_radius=2, border_thicknes
     with open(os.path.join(folder, 'regions', 'consensus_regions.json')) as f:
         cell_masks = [np.array(x['coordinates']) for x in json.load(f)]
 
-    # compute masks for each neuron
-    masks_soma, masks_border, masks_centroids = \
-        [np.zeros((len(cell_masks), dimensions[0], dimensions[1]), dtype=bool) for _ in range(3)]
+    # no labeled cells, so all masks are empty
+    if len(cell_masks) == 0:
+        shape = tuple(dimensions) if collapse_masks else (0, dimensions[0], dimensions[1])
+        return {k: np.zeros(shape, dtype=bool) for k in ('somas', 'borders', 'centroids')}
 
-    for i, cell in enumerate(cell_masks):
-        masks_soma[i, cell[:, 0], cell[:, 1]] = True
-        _, contour, _ = cv2.findContours(masks_soma[i].astype('uint8'), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-        masks_border[i] = cv2.drawContours(np.zeros(dimensions), contour, 0, 1, thickness=border_thickness).astype('bool')
-        center = np.mean(cell, 0).astype('int')
-        masks_centroids[i] = cv2.circle(masks_centroids[i].astype('uint8'), (center[1], center[0]), centroid_radius, 1, thickness=-1)
+    # compute masks for each neuron
+    masks_soma, masks_centroids = \
+        [np.zeros((len(cell_masks), dimensions[0], dimensions[1]), dtype=bool) for _ in range(2)]
+    cell_lengths = [len(cell) for cell in cell_masks]
+    cell_ids = np.repeat(np.arange(len(cell_masks)), cell_lengths)
+    coords = np.concatenate(cell_masks)
+    masks_soma[cell_ids, coords[:, 0], coords[:, 1]] = True
+
+    # borders are the somas dilated minus the somas eroded, with a wider erosion so the border extends further into the
+    # cell than out of it, like the contours previously drawn with cv2.drawContours // cells are stacked vertically so
+    # opencv processes all of them at once, with edge padding between cells so they don't bleed into one another
+    pad = border_thickness + 1
+    somas_stacked = np.pad(masks_soma, ((0, 0), (pad, pad), (0, 0)), mode='edge').astype('uint8')
+    somas_stacked = somas_stacked.reshape(-1, dimensions[1])
+    dilated = cv2.dilate(somas_stacked, np.ones((border_thickness + 1, border_thickness + 1), dtype='uint8'))
+    eroded = cv2.erode(somas_stacked, np.ones((2*border_thickness + 1, 2*border_thickness + 1), dtype='uint8'))
+    masks_border = (dilated > eroded).reshape(len(cell_masks), -1, dimensions[1])[:, pad:-pad]
+
+    # centroids are disks around the center of each cell
+    centers = (np.add.reduceat(coords, np.cumsum([0] + cell_lengths[:-1])) / np.array(cell_lengths)[:, np.newaxis])
+    centers = centers.astype('int')
+    disk = cv2.circle(np.zeros((centroid_radius*2+1, centroid_radius*2+1), dtype='uint8'),
+                      (centroid_radius, centroid_radius), centroid_radius, 1, thickness=-1)
+    disk_offsets = np.argwhere(disk) - centroid_radius
+    disk_rows = (centers[:, np.newaxis, 0] + disk_offsets[:, 0]).flatten()
+    disk_cols = (centers[:, np.newaxis, 1] + disk_offsets[:, 1]).flatten()
+    disk_ids = np.repeat(np.arange(len(cell_masks)), len(disk_offsets))
+    in_frame = (disk_rows >= 0) & (disk_rows < dimensions[0]) & (disk_cols >= 0) & (disk_cols < dimensions[1])
+    masks_centroids[disk_ids[in_frame], disk_rows[in_frame], disk_cols[in_frame]] = True
 
     # collapse across neurons
     if collapse_masks:
@@ -154,18 +258,21 @@ def get_targets(folder, collapse_masks=False, centroid_radius=2, border_thicknes
 def add_contours(img, contour, color=(1, 0, 0)):
     """given 2D img, and 2D contours, returns 3D image with contours added in color"""
 
-    img_contour = np.repeat(img[:,:,np.newaxis], 3, axis=2)
-    inds = np.argwhere(contour)
-    img_contour[inds[:, 0], inds[:, 1], :] = np.array(color)
+    img_contour = np.empty(img.shape + (3,), dtype=img.dtype)
+    img_contour[...] = img[:, :, np.newaxis]
+    img_contour[contour.astype(bool)] = color
 
     return img_contour
 
 
-def enhance_contrast(img, percentiles=(5, 95)):
-    """given 2D image, rescales the image between lower and upper percentile limits"""
+def enhance_contrast(img, percentiles=(5, 95), axis=None):
+    """
+    given 2D image, rescales the image between lower and upper percentile limits // if axis is provided, limits are
+    computed separately for each slice along the remaining dimensions, e.g. axis=(0, 1) for each channel
+    """
 
-    limits = np.percentile(img.flatten(), percentiles)
-    img = np.clip(img-limits[0], 0, limits[1]-limits[0]) / np.ptp(limits)
+    limits = np.percentile(img, percentiles, axis=axis, keepdims=True)
+    img = np.clip(img-limits[0], 0, limits[1]-limits[0]) / (limits[1]-limits[0])
     # img = np.clip(img, limits[0], limits[1]) / np.ptp(limits)
 
     return img
@@ -174,30 +281,18 @@ def enhance_contrast(img, percentiles=(5, 95)):
 def save_prediction_img(file, X, y, y_pred=None, height=800, X_contrast=(0,100), column_titles=None):
     """ given X and y_pred for a single image, (network output), writes an image to file concatening everybody """
 
-    # scaled from 0->1
-    for i in range(X.shape[-1]):
-        X[:, :, i] = scale_img(X[:, :, i])
-        if X_contrast != (0, 100):
-            X[:, :, i] = enhance_contrast(X[:, :, i], percentiles=X_contrast)
+    # scaled from 0->1, separately for each channel
+    X = scale_img(X, axis=(0, 1))
+    if X_contrast != (0, 100):
+        X = enhance_contrast(X, percentiles=X_contrast, axis=(0, 1))
     if type(y_pred) == np.ndarray:
-        for i in range(y_pred.shape[-1]):
-            y_pred[:, :, i] = scale_img(y_pred[:, :, i])
-
-    # concatenate layers horizontally
-    X_cat = np.reshape(X, (X.shape[0], -1), order='F')
-    y_cat = np.reshape(y, (y.shape[0], -1), order='F')
-    if type(y_pred)==np.ndarray:
-        y_pred_cat = np.reshape(y_pred, (y_pred.shape[0], -1), order='F')
-
-    # make image where three rows are X, y, and y_pred
-    if type(y_pred)==np.ndarray:
-        cat = np.zeros((X.shape[0]*3, max(X_cat.shape[1], y_cat.shape[1])))
-    else:
-        cat = np.zeros((X.shape[0] * 2, max(X_cat.shape[1], y_cat.shape[1])))
-    cat[:X.shape[0], :X_cat.shape[1]] = X_cat
-    cat[X.shape[0]:X.shape[0]*2, :y_cat.shape[1]] = y_cat
-    if type(y_pred)==np.ndarray:
-        cat[X.shape[0]*2:, :y_cat.shape[1]] = y_pred_cat
+        y_pred = scale_img(y_pred, axis=(0, 1))
+
+    # make image where three rows are X, y, and y_pred, with channels concatenated horizontally
+    rows = [X, y, y_pred] if type(y_pred) == np.ndarray else [X, y]
+    cat = np.zeros((X.shape[0]*len(rows), X.shape[1]*max(X.shape[-1], y.shape[-1])))
+    for i, r in enumerate(rows):
+        cat[X.shape[0]*i:X.shape[0]*(i+1), :r.shape[1]*r.shape[2]] = r.transpose(0, 2, 1).reshape(r.shape[0], -1)
 
     img = Image.fromarray((cat * 255).astype('uint8'))
 
@@ -222,11 +317,3 @@ def write_sample_imgs(X_contrast=(0,100)):
         y_mat = np.stack(data['y'][()].values(), axis=2)
         file_name = os.path.join(cfg.data_dir, 'training_data', os.path.splitext(f)[0] + '.png')
         save_prediction_img(file_name, X_mat, y_mat, X_contrast=X_contrast, column_titles=data['X'][()].keys())
-
-
-
-
-
-
-
-
@@ -21,6 +21,8 @@ extra output to regress onto whisker points
 dataset_name = 'scaling0.50_tracesTrue_points8_tracefiltering_25_pointfiltering5_imgs9238'
 network_structure = 'hourglass' # leap, hourglass, or stacked_hourglass
 use_cpu = False
+use_mixed_precision = False # float16 training, faster on gpus with tensor cores
+xla_jit = True # compile model with xla
 test_set_portion = .1
 lr_init = .001
 batch_size = 16
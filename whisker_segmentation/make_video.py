@@ -1,5 +1,5 @@
 import cv2
-from keras.models import load_model
+from tensorflow.keras.models import load_model
 from config import model_folder, vid_name
 import os
 from utils import add_labels_to_frame, add_maxima_to_frame
@@ -1,16 +1,15 @@
 from utils import DataGenerator
 from models import models_dict
 from evaluate_model import evaluate_model
-from keras.optimizers import Adam
-from keras.models import load_model
+from tensorflow.keras.optimizers import Adam
+from tensorflow.keras.models import load_model
 import numpy as np
 import tensorflow as tf
-import keras.backend as K
-from keras.callbacks import EarlyStopping, ModelCheckpoint
+from tensorflow.keras.callbacks import EarlyStopping, ModelCheckpoint
 import losswise
 from losswise.libs import LosswiseKerasCallback
 import tables
-from config import test_set_portion, dataset_name, lr_init, first_layer_filters, batch_size, use_cpu, training_epochs, kernel_size, use_sample_weights, sample_weight_lims, network_structure
+from config import test_set_portion, dataset_name, lr_init, first_layer_filters, batch_size, use_cpu, training_epochs, kernel_size, use_sample_weights, sample_weight_lims, network_structure, xla_jit
 from datetime import datetime
 import os
 import pickle
@@ -19,6 +18,9 @@ from tqdm import tqdm
 
 losswise.set_api_key('9BDAXRBWA') # set up losswise.com visualization
 
+if use_cpu:
+    tf.config.set_visible_devices([], 'GPU') # must happen before any tensorflow ops run
+
 
 
 # prepare sample weights
@@ -45,6 +47,8 @@ with tables.open_file(os.path.join('data',dataset_name+'.h5'), 'r') as dataset:
 
 
     # create model and data generators
+    if xla_jit:
+        tf.config.optimizer.set_jit(True) # autoclustering // let xla fuse the conv, bias, and relu ops in residual modules
     train_generator = DataGenerator(train_inds, dataset, batch_size=batch_size, shuffle=True, sample_weights=sample_weights, 
                                     num_loss_fcns=2 if network_structure=='stacked_hourglass' else 1)
     test_generator = DataGenerator(test_inds, dataset, batch_size=batch_size, shuffle=False, sample_weights=sample_weights, 
@@ -53,14 +57,10 @@ with tables.open_file(os.path.join('data',dataset_name+'.h5'), 'r') as dataset:
 
     model = models_dict(network_structure)((train_generator.img_dims[0], train_generator.img_dims[1], 1), train_generator.channels, first_layer_filters, 
                                            kernel_size = kernel_size,
-                                           optimizer = Adam(lr=lr_init),
+                                           optimizer = Adam(learning_rate=lr_init),
                                            loss_fcn = 'mean_squared_error')
 
     # train, omg!
-    if use_cpu:
-        config = tf.ConfigProto(device_count={'GPU':0})
-        sess = tf.Session(config=config)
-        K.set_session(sess)
          
     model_folder = datetime.now().strftime('%y%m%d_%H.%M.%S')
     model_path = os.path.join('models', model_folder)
@@ -68,13 +68,14 @@ with tables.open_file(os.path.join('data',dataset_name+'.h5'), 'r') as dataset:
     callbacks = [EarlyStopping(patience=10, verbose=1), # stop when validation loss stops increasing
                ModelCheckpoint(os.path.join(model_path, '%s_filters%i_kern%i_sampleweights%s_weights.{epoch:02d}-{val_loss:.6f}.hdf5'%(model.name, first_layer_filters, kernel_size, 'ON' if use_sample_weights else 'OFF')), save_best_only=True), # save models periodically
                LosswiseKerasCallback(tag='giterdone', display_interval=1)] # show progress on losswise.com
-    history = model.fit_generator(generator=train_generator, validation_data=test_generator, epochs=training_epochs, callbacks=callbacks)
+    history = model.fit(train_generator, validation_data=test_generator, epochs=training_epochs, callbacks=callbacks)
     with open(os.path.join(model_path, 'training_history'), 'wb') as training_file:
         pickle.dump(history.history, training_file)
     
     # load best model and delete others
-    models_to_delete = glob(os.path.join(model_path,'*hdf5'))[:-1]
-    [os.remove(mod) for mod in iter(models_to_delete)]
+    models_to_delete = sorted(glob(os.path.join(model_path,'*hdf5')), key=os.path.getmtime)[:-1] # most recent model is the best
+    for mod in models_to_delete:
+        os.remove(mod)
     model = load_model(glob(os.path.join(model_path, '*.hdf5'))[0])
     
     